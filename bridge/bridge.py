@@ -31,6 +31,9 @@ class Bridge:
         # Construct inbound request queue
         self._inbound_queue = asyncio.Queue(maxsize=64)
 
+        # Reset get request queued flag (one queued get request is sufficient)
+        self._get_queued = False
+
         # Reset last query time
         self._last_query_time = 0
 
@@ -61,6 +64,12 @@ class Bridge:
 
         return self._serial_no
 
+    @property
+    def state(self):
+        """Retrieve persistent state for PSU"""
+
+        return self._persistent_state
+
     @property
     def client(self):
         """Retrieve pymodbus client for PSU"""
@@ -70,9 +79,14 @@ class Bridge:
     def queue_state_get(self):
         """Queue a state get request for PSU"""
 
+        # Skip if a get request is already waiting to be processed
+        if self._get_queued:
+            return
+
         # Push get request
         try:
             self._inbound_queue.put_nowait((False, None))
+            self._get_queued = True
         except asyncio.QueueFull:
             pass
 
@@ -82,6 +96,9 @@ class Bridge:
         # Push set request
         try:
             self._inbound_queue.put_nowait((True, request))
+
+            # Clear queued get flag, such that any get following the set isn't skipped (reporting state from before the set)
+            self._get_queued = False
         except asyncio.QueueFull:
             pass
 
@@ -173,6 +190,7 @@ class Bridge:
         else:
             # Get request, query unit state
             self._logger.debug("Get state for %s", self._identity)
+            self._get_queued = False
             await self._get_state()
 
     async def _set_clock(self):
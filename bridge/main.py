@@ -85,6 +85,15 @@ def main():
                                mqtt_reconnect_delay_secs=mqtt_reconnect_delay_secs,
                                set_clock_on_connection=set_clock_on_connection)
 
+    # Use uvloop for the asyncio event loop where available (not supported on Windows)
+    if sys.platform.lower() != "win32":
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            # Fall back to the default event loop
+            pass
+
     # Run service
     asyncio.run(mqtt_bridge.run())
 
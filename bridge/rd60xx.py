@@ -1,4 +1,4 @@
-from typing import Any, Optional
+from typing import Any, Optional, Tuple
 import enum
 import time
 
@@ -366,22 +366,8 @@ class RD60xx(AsyncModbusReverseTcpClient):
             # Helper to convert temperatures
             temp = lambda sign, val : (-1 if geta(sign) == 1 else 1) * geta(val)
 
-            # Lookup voltage and current scaling, with and without hardware revision
-            model_inc_hw_rev = geta(self.RD60xxRegisters.MODEL)
-            model_exc_hw_rev = model_inc_hw_rev // 10
-            if model_inc_hw_rev in self.MODEL_VOLTAGE_SCALINGS:
-                voltage_scale = self.MODEL_VOLTAGE_SCALINGS.get(model_inc_hw_rev)
-            else:
-                voltage_scale = self.MODEL_VOLTAGE_SCALINGS.get(model_exc_hw_rev)
-            if model_inc_hw_rev in self.MODEL_CURRENT_SCALINGS:
-                current_scale = self.MODEL_CURRENT_SCALINGS.get(model_inc_hw_rev)
-            else:
-                current_scale = self.MODEL_CURRENT_SCALINGS.get(model_exc_hw_rev)
-            if voltage_scale is None or current_scale is None:
-                raise Exception("Unknown model, cannot scale voltage and current")
-
-            # Split current scale
-            current_scale, use_current_range = current_scale
+            # Lookup voltage and current scaling
+            voltage_scale, current_scale, use_current_range = self._lookup_scales(geta(self.RD60xxRegisters.MODEL))
 
             # Snapshot current scale before applying range
             current_scale_without_range = current_scale
@@ -479,17 +465,10 @@ class RD60xx(AsyncModbusReverseTcpClient):
             # Update last read time
             self._presets_last_read = curr_time
 
-    async def set_state(self, new_state:RD60xxStateSet):
-        """Write new state to PSU"""
+    def _lookup_scales(self, model_inc_hw_rev:int) -> Tuple[float, float, bool]:
+        """Lookup voltage and current scaling (and whether current range is used), with and without hardware revision"""
 
-        # Query unit model to lookup scalings
-        response = await self.read_holding_registers(slave=self.PSU_ADDR,
-                                                     address=self.RD60xxRegisters.MODEL.value,
-                                                     count=1)
-        model_inc_hw_rev = response.registers[0]
         model_exc_hw_rev = model_inc_hw_rev // 10
-
-        # Lookup voltage and current scaling, with and without hardware revision
         if model_inc_hw_rev in self.MODEL_VOLTAGE_SCALINGS:
             voltage_scale = self.MODEL_VOLTAGE_SCALINGS.get(model_inc_hw_rev)
         else:
@@ -504,6 +483,19 @@ class RD60xx(AsyncModbusReverseTcpClient):
         # Split current scale
         current_scale, use_current_range = current_scale
 
+        return (voltage_scale, current_scale, use_current_range)
+
+    async def set_state(self, new_state:RD60xxStateSet):
+        """Write new state to PSU"""
+
+        # Query unit model to lookup scalings
+        response = await self.read_holding_registers(slave=self.PSU_ADDR,
+                                                     address=self.RD60xxRegisters.MODEL.value,
+                                                     count=1)
+
+        # Lookup voltage and current scaling
+        voltage_scale, current_scale, use_current_range = self._lookup_scales(response.registers[0])
+
         # Retrieve current range
         if use_current_range:
             # Query unit model to lookup current scale
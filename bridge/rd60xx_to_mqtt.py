@@ -1,19 +1,36 @@
-from typing import Dict, Optional, Tuple
+from typing import Dict, Optional, Tuple, Union
 import asyncio
-import json
 import logging
 import signal
 import time
 
 import aiomqtt
 
+# Prefer orjson for MQTT payloads, falling back to standard library json (which encodes to str rather than bytes)
+try:
+    import orjson
+except ImportError:
+    import json as orjson
+
 from rd60xx import RD60xx
 from bridge import Bridge
 from psu_state import PSUStates
 
+# Accepted types for update period (matched exactly, as bool is a subclass of int)
+PERIOD_TYPES = (int, float)
+
+# State set request fields which alter PSU state (and so warrant querying the PSU afterwards)
+STATE_CHANGING_KEYS = frozenset(("preset_index", "output_voltage_set", "output_current_set", "ovp", "ocp", "output_enable", "output_toggle"))
+
 class RD60xxToMQTT:
     """Remote control Riden RD60xx PSU's via MQTT"""
 
+    # Maximum number of queued MQTT messages published in a single batch
+    PUBLISH_BATCH_SIZE = 64
+
+    # Delay between last state set request and querying PSU to publish its new state
+    STATE_QUERY_DELAY = 0.5 # sec
+
     def __init__(self,
                  hostname:str,
                  port:int,
@@ -47,6 +64,13 @@ class RD60xxToMQTT:
         self._mqtt_reconnect_delay_secs = mqtt_reconnect_delay_secs
         self._set_clock_on_connection = set_clock_on_connection
 
+        # Create TLS params (fixed for lifetime of service, so reused across reconnects)
+        self._tls_params = None
+        self._tls_insecure = None
+        if (self._ca_cert is not None or (self._client_cert is not None and self._client_key is not None)):
+            self._tls_params = aiomqtt.TLSParameters(self._ca_cert, self._client_cert, self._client_key)
+            self._tls_insecure = self._insecure
+
         # Retrieve logger
         self._logger = logging.getLogger("RD60xxToMQTT")
 
@@ -56,12 +80,46 @@ class RD60xxToMQTT:
         # Newly connected PSUs
         self._new_psu_queue = asyncio.Queue(maxsize=16)
 
+        # Outbound MQTT messages (topic, payload), awaiting publishing
+        self._publish_queue = asyncio.Queue(maxsize=256)
+
         # Persistent state (data assoicated with PSU thats persisted across unit connections)
         self._psu_states = PSUStates()
 
         # Map of connected PSUs (serial no -> rd60xxmqtt instances)
         self._psus = {}
 
+        # Map of connected PSU clients -> identity
+        self._client_to_identity:Dict[RD60xx, str] = {}
+
+        # Map of connected PSUs identity -> PSU list entry
+        self._psu_list_entries:Dict[str, dict] = {}
+
+        # Map of PSU identity -> pending state query timer
+        self._pending_timers:Dict[str, asyncio.TimerHandle] = {}
+
+        # Map of PSU identity -> state topic (for PSUs which have connected)
+        self._state_topics:Dict[str, str] = {}
+
+        # PSU list topic and cached JSON encoded list (reset when connected PSUs change)
+        self._psu_list_topic = f"{self._mqtt_base_topic}/psu/list"
+        self._psu_list_cache:Optional[Union[bytes, str]] = None
+
+        # Prepare wildcards for inbound topics
+        self._wildcard_psus_get = f"{self._mqtt_base_topic}/psu/list/get"
+        self._wildcard_state_get = f"{self._mqtt_base_topic}/psu/+/state/get"
+        self._wildcard_state_set = f"{self._mqtt_base_topic}/psu/+/state/set"
+
+        # Length of base topic prefix, stripped from inbound topics
+        self._base_prefix_len = len(self._mqtt_base_topic) + 1
+
+        # Map of inbound topic suffix -> handler
+        self._topic_handlers = {
+            ("state", "set") : self._handle_state_set,
+            ("state", "get") : self._handle_state_get,
+            ("list", "get") : self._handle_psu_list_get,
+        }
+
         # Reset MQTT client
         self._mqtt_client = None
 
@@ -71,9 +129,14 @@ class RD60xxToMQTT:
         # Retreive event loop
         loop = asyncio.get_event_loop()
 
+        # Run new tasks eagerly up to their first suspension point where supported (Python 3.12+)
+        eager_task_factory = getattr(asyncio, "eager_task_factory", None)
+        if eager_task_factory is not None:
+            loop.set_task_factory(eager_task_factory)
+
         # Register the signal handler
         for signame in ['SIGINT', 'SIGTERM']:
-            loop.add_signal_handler(getattr(signal, signame), lambda: asyncio.create_task(self._handle_signal(signame)))
+            loop.add_signal_handler(getattr(signal, signame), self._handle_signal, signame)
 
         # Create TCP server, waiting for PSU clients to connect
         psu_server = await loop.create_server(
@@ -86,6 +149,9 @@ class RD60xxToMQTT:
         # Create task to manage MQTT connection and process inbound messages
         mqtt_task = loop.create_task(self._mqtt_inbound())
 
+        # Create task to publish outbound MQTT messages
+        publisher_task = loop.create_task(self._publisher_task())
+
         # Create task to on-board new PSUs (as we cant execute async functions in the non-async callback)
         psu_task = loop.create_task(self._psu_task())
 
@@ -95,16 +161,22 @@ class RD60xxToMQTT:
 
         # Stop tasks
         mqtt_task.cancel()
+        publisher_task.cancel()
         psu_server.close()
         psu_task.cancel()
         for _, psu in self._psus.items():
             psu.cancel()
         self._psus.clear()
+        self._client_to_identity.clear()
+        self._psu_list_entries.clear()
+        for _, handle in self._pending_timers.items():
+            handle.cancel()
+        self._pending_timers.clear()
 
         # All done
         self._logger.info("Bye")
 
-    async def _handle_signal(self, signal_name:str):
+    def _handle_signal(self, signal_name:str):
         """Handle OS signal"""
 
         # Log signal and set shutdown event
@@ -134,18 +206,34 @@ class RD60xxToMQTT:
         # Reset host and port
         host_port = "0.0.0.0:0"
 
-        # Iterate over PSUs
-        for identity, psu in self._psus.items():
-            if client == psu.client:
-                # Found PSU, retrieve host and port
-                host_port = psu.host_port
+        # Lookup identity of PSU
+        identity = self._client_to_identity.pop(client, None)
 
-                # Cancel PSU background task
-                self._psus[identity].cancel()
+        # Lookup PSU (ignoring it if its identity has since reconnected via a new client)
+        psu = self._psus.get(identity)
+        if psu is not None and psu.client == client:
+            # Found PSU, retrieve host and port
+            host_port = psu.host_port
 
-                # Remove from dictionary
-                del self._psus[identity]
-                break
+            # Cancel PSU background task
+            psu.cancel()
+
+            # Remove from dictionaries
+            del self._psus[identity]
+            del self._psu_list_entries[identity]
+
+            # Cancel pending state query
+            handle = self._pending_timers.pop(identity, None)
+            if handle is not None:
+                handle.cancel()
+
+            # Invalidate cached PSU list
+            self._psu_list_cache = None
+
+            # Publish disconnected state and updated PSU list (queued directly, as we're not in a coroutine)
+            state = self._psu_states.get_state(identity, create=False)
+            self._queue_state(identity, {"connected" : False, "period" : (state.update_period if state is not None else 0)})
+            self._send_psu_list()
 
         # Aww
         self._logger.info("PSU disconnected (%s)", host_port)
@@ -158,18 +246,11 @@ class RD60xxToMQTT:
 
         while True:
             try:
-                # Create TLS params
-                tls_params = None
-                tls_insecure = None
-                if (self._ca_cert is not None or (self._client_cert is not None and self._client_key is not None)):
-                    tls_params = aiomqtt.TLSParameters(self._ca_cert, self._client_cert, self._client_key)
-                    tls_insecure = self._insecure
-
                 # Construct client
                 async with aiomqtt.Client(hostname=self._hostname, port=self._port,
                                           username=self._username, password=self._password,
-                                          tls_params=tls_params,
-                                          tls_insecure=tls_insecure,
+                                          tls_params=self._tls_params,
+                                          tls_insecure=self._tls_insecure,
                                           client_id=self._client_id) as client:
                     # Yey
                     self._logger.info("MQTT connected!")
@@ -178,14 +259,15 @@ class RD60xxToMQTT:
                     self._mqtt_client = client
 
                     # Subscribe to PSU topics
-                    await client.subscribe(f"{self._mqtt_base_topic}/psu/list/get", qos=0)
-                    await client.subscribe(f"{self._mqtt_base_topic}/psu/+/state/get", qos=0)
-                    await client.subscribe(f"{self._mqtt_base_topic}/psu/+/state/set", qos=2)
+                    await client.subscribe(self._wildcard_psus_get, qos=0)
+                    await client.subscribe(self._wildcard_state_get, qos=0)
+                    await client.subscribe(self._wildcard_state_set, qos=2)
 
-                    # Prepare wildcards
-                    wildcard_psus_get = f"{self._mqtt_base_topic}/psu/list/get"
-                    wildcard_state_get = f"{self._mqtt_base_topic}/psu/+/state/get"
-                    wildcard_state_set = f"{self._mqtt_base_topic}/psu/+/state/set"
+                    # Bind attributes used per message to locals
+                    base_prefix_len = self._base_prefix_len
+                    psus_get = self._psus.get
+                    handlers_get = self._topic_handlers.get
+                    logger_debug = self._logger.debug
 
                     # Retrive messages
                     async with client.messages() as messages:
@@ -193,62 +275,25 @@ class RD60xxToMQTT:
                         async for message in messages:
                             # Attempt to de-serialize message
                             try:
-                                payload = json.loads(message.payload)
+                                payload = orjson.loads(message.payload)
                             except:
                                 payload = None
 
-                            # Extract identity from topic
-                            topic = message.topic.value[len(f"{self._mqtt_base_topic}/"):]
-                            identity = topic.split("/")[1]
+                            # Split topic (after base topic) and extract identity
+                            topic = message.topic.value[base_prefix_len:]
+                            parts = topic.split("/")
+                            identity = parts[1]
 
                             # Lookup PSU
-                            psu:Bridge = self._psus.get(identity)
-
-                            # Log msg
-                            self._logger.debug("Msg arrived on topic: '%s', for identity: '%s' with payload: '%s'", topic, identity, repr(payload))
-
-                            # Act on topics
-                            if message.topic.matches(wildcard_state_set) and not payload is None:
-                                # Set state request, retrieve state for PSU
-                                state = self._psu_states.get_state(identity, create=False)
-
-                                # Handle period first
-                                if type(payload.get("period")) in (int, float) and state is not None:
-                                    # Retrieve and limit period
-                                    update_period = payload["period"]
-                                    if update_period != 0:
-                                        # Limit to 100ms updates
-                                        update_period = max(update_period, 0.1)
-
-                                    # Set new update period
-                                    self._logger.debug("Update identity %s period to %d", identity, update_period)
-                                    state.update_period = update_period
-
-                                # Pass request to PSU if connected
-                                if psu is not None:
-                                    self._logger.debug("Set identity %s state to %s", identity, repr(payload))
-                                    psu.queue_state_set(payload)
-
-                            elif message.topic.matches(wildcard_state_get):
-                                # Get state request, check if we should query the unit
-                                if not payload is None and payload.get("query", False) and psu is not None:
-                                    # We should query the unit and we can
-                                    self._logger.debug("Get identity %s state with query", identity)
-                                    psu.queue_state_get()
-
-                                else:
-                                    # Nope, just checking if the unit is connected, or attempting to query it but its not connected
-                                    resp = {}
-                                    resp["connected"] = (psu is not None)
-                                    state = self._psu_states.get_state(identity, create=False)
-                                    resp["period"] = (state.update_period if state is not None else 0)
-                                    self._logger.debug("Get identity %s state without query", identity)
-                                    await self._mqtt_outbound(identity, resp)
-
-                            elif message.topic.matches(wildcard_psus_get):
-                                # Send PSU list
-                                self._logger.debug("Get psu list")
-                                await self._send_psu_list()
+                            psu:Bridge = psus_get(identity)
+
+                            # Log msg (leaving logger to format payload only if debug enabled)
+                            logger_debug("Msg arrived on topic: '%s', for identity: '%s' with payload: '%r'", topic, identity, payload)
+
+                            # Act on topics, based on their final two levels
+                            handler = handlers_get(tuple(parts[-2:]))
+                            if handler is not None:
+                                await handler(identity, psu, payload)
 
             except aiomqtt.MqttError as error:
                 # MQTT connection failed
@@ -270,18 +315,141 @@ class RD60xxToMQTT:
                 self._logger.exception("General error, reconnecting in %d seconds.", self._mqtt_reconnect_delay_secs)
                 await asyncio.sleep(self._mqtt_reconnect_delay_secs)
 
+    async def _handle_state_set(self, identity:str, psu:Optional[Bridge], payload):
+        """Handle set state request"""
+
+        # Ignore requests which failed to de-serialize
+        if payload is None:
+            return
+
+        # Retrieve state for PSU (from bridge if connected)
+        state = psu.state if psu is not None else self._psu_states.get_state(identity, create=False)
+
+        # Handle period first
+        update_period = payload.get("period")
+        if type(update_period) in PERIOD_TYPES and state is not None:
+            # Limit period
+            if update_period != 0:
+                # Limit to 100ms updates
+                update_period = max(update_period, 0.1)
+
+            # Set new update period
+            self._logger.debug("Update identity %s period to %d", identity, update_period)
+            state.update_period = update_period
+
+        # Pass request to PSU if connected
+        if psu is not None:
+            self._logger.debug("Set identity %s state to %r", identity, payload)
+            psu.queue_state_set(payload)
+
+            # Query PSU once requests stop arriving, (re)starting timer to publish its new state
+            if not STATE_CHANGING_KEYS.isdisjoint(payload):
+                handle = self._pending_timers.pop(identity, None)
+                if handle is not None:
+                    handle.cancel()
+                self._pending_timers[identity] = asyncio.get_running_loop().call_later(self.STATE_QUERY_DELAY, self._fire_state_query, identity)
+
+    def _fire_state_query(self, identity:str) -> None:
+        """Query PSU following state set requests"""
+
+        # Timer has fired
+        self._pending_timers.pop(identity, None)
+
+        # Queue query if PSU still connected
+        psu = self._psus.get(identity)
+        if psu is not None:
+            self._logger.debug("Get identity %s state following set", identity)
+            psu.queue_state_get()
+
+    async def _handle_state_get(self, identity:str, psu:Optional[Bridge], payload):
+        """Handle get state request"""
+
+        # Check if we should query the unit
+        if not payload is None and payload.get("query", False) and psu is not None:
+            # We should query the unit and we can
+            self._logger.debug("Get identity %s state with query", identity)
+            psu.queue_state_get()
+
+        else:
+            # Nope, just checking if the unit is connected, or attempting to query it but its not connected
+            resp = {}
+            resp["connected"] = (psu is not None)
+            state = psu.state if psu is not None else self._psu_states.get_state(identity, create=False)
+            resp["period"] = (state.update_period if state is not None else 0)
+            self._logger.debug("Get identity %s state without query", identity)
+            await self._mqtt_outbound(identity, resp)
+
+    async def _handle_psu_list_get(self, identity:str, psu:Optional[Bridge], payload):
+        """Handle PSU list request"""
+
+        # Send PSU list
+        self._logger.debug("Get psu list")
+        self._send_psu_list()
+
     async def _mqtt_outbound(self, identity:str, state:dict):
         """Send MQTT state message on behalf of caller"""
 
+        self._queue_state(identity, state)
+
+    def _queue_state(self, identity:str, state:dict) -> None:
+        """Queue MQTT state message for publishing"""
+
         if self._mqtt_client:
-            # Publish message
-            try:
+            # Lookup topic, formatting it for PSUs which haven't connected
+            topic = self._state_topics.get(identity)
+            if topic is None:
                 topic = f"{self._mqtt_base_topic}/psu/{identity}/state"
-                self._logger.debug("Msg leaving on topic: '%s', for identity: '%s' with payload: '%s'", topic, identity, repr(state))
-                await self._mqtt_client.publish(topic, payload=json.dumps(state))
-            except aiomqtt.MqttError:
-                # Ignore MQTT errors
-                pass
+
+            # Queue message for publishing
+            self._logger.debug("Msg leaving on topic: '%s', for identity: '%s' with payload: '%r'", topic, identity, state)
+            self._queue_publish(topic, orjson.dumps(state))
+
+    def _queue_publish(self, topic:str, payload:Union[bytes, str]) -> None:
+        """Queue MQTT message for publishing by publisher task"""
+
+        try:
+            self._publish_queue.put_nowait((topic, payload))
+        except asyncio.QueueFull:
+            # Drop message, as we would if the broker was unavailable
+            self._logger.warning("Publish queue full, dropping msg on topic: '%s'", topic)
+
+    async def _publisher_task(self):
+        """Publish queued MQTT messages, coalescing bursts into a single batch"""
+
+        # Entry
+        self._logger.info("Publisher task running")
+
+        # Retrieve PSU list topic
+        psu_list_topic = self._psu_list_topic
+
+        try:
+            while True:
+                # Wait for a message, then drain any others already queued behind it
+                batch = [await self._publish_queue.get()]
+                while len(batch) < self.PUBLISH_BATCH_SIZE:
+                    try:
+                        batch.append(self._publish_queue.get_nowait())
+                    except asyncio.QueueEmpty:
+                        break
+
+                # Only the most recent PSU list in a batch is worth sending
+                psu_lists = [x for x in batch if x[0] == psu_list_topic]
+                if len(psu_lists) > 1:
+                    batch = [x for x in batch if x[0] != psu_list_topic] + psu_lists[-1:]
+
+                # Publish batch back-to-back, ignoring MQTT errors
+                client = self._mqtt_client
+                if client:
+                    results = await asyncio.gather(*(client.publish(topic, payload=payload) for topic, payload in batch), return_exceptions=True)
+
+                    # Log any other errors, rather than silently dropping them
+                    for (topic, _), result in zip(batch, results):
+                        if isinstance(result, Exception) and not isinstance(result, aiomqtt.MqttError):
+                            self._logger.error("Error publishing msg on topic: '%s'", topic, exc_info=result)
+
+        except asyncio.CancelledError:
+            # Task cancelled
+            self._logger.info("Publisher task stopped")
 
     async def _psu_task(self):
         """Handle newly connected PSUs"""
@@ -289,8 +457,8 @@ class RD60xxToMQTT:
         # Entry
         self._logger.info("PSU task running")
 
-        # Map of IP -> PSU identity / connection time
-        identity_cache:Dict[str, Tuple[str, int]] = {}
+        # Map of IP -> PSU identity / model / serial number / connection time
+        identity_cache:Dict[str, Tuple[str, int, int, float]] = {}
 
         try:
             # Retireve PSUs from queue
@@ -298,80 +466,100 @@ class RD60xxToMQTT:
                 # Fetch newly connected PSU
                 psu, host, port = await self._new_psu_queue.get()
 
-                # Lookup identity from IP
-                identity, last_connection = identity_cache.get(host, (None, None))
+                # On-board it, along with any other PSUs which connected in the meantime
+                psus_added = False
+                while True:
+                    psus_added |= await self._add_psu(identity_cache, psu, host, port)
 
-                # Retrieve time
-                time_now = time.monotonic()
+                    try:
+                        psu, host, port = self._new_psu_queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
 
-                if identity is not None:
-                    # Identity found, calculate elapsed time between now and when PSU last connected
-                    time_diff = time_now - last_connection
+                # Send updated PSU list, once per batch
+                if psus_added:
+                    self._send_psu_list()
 
-                    # Check against limit
-                    if time_diff > self._ip_to_identity_cache_timeout_secs:
-                        # PSU has been offline for longer than cache limit, force re-query
-                        identity = None
-                        last_connection = None
+        except asyncio.CancelledError:
+            # Task cancelled
+            self._logger.info("PSU task stopped")
 
-                if identity is None:
-                    # Query PSU to retrieve model and serial number (forming identity)
-                    query_result = await psu.get_state()
+    async def _add_psu(self, identity_cache:Dict[str, Tuple[str, int, int, float]], psu:RD60xx, host:str, port:int) -> bool:
+        """Identify newly connected PSU and create bridge for it, returning false if PSU couldn't be identified"""
 
-                    if query_result is None:
-                        # Query failed, close connection
-                        psu.close()
-                        continue
+        # Lookup identity from IP
+        identity, model, serial_no, last_connection = identity_cache.get(host, (None, None, None, None))
 
-                    # Retrieve model and serial number from query result
-                    model = query_result.model
-                    serial_no = query_result.serial_no
+        # Retrieve time
+        time_now = time.monotonic()
 
-                    # Generate identity, combining model and serial number for cases where a user has
-                    # multiple series of PSU with overlapping serial number ranges
-                    identity = f"{model}_{serial_no}"
+        if identity is not None:
+            # Identity found, calculate elapsed time between now and when PSU last connected
+            time_diff = time_now - last_connection
 
-                # Update last connection time
-                last_connection = time_now
+            # Check against limit
+            if time_diff > self._ip_to_identity_cache_timeout_secs:
+                # PSU has been offline for longer than cache limit, force re-query
+                identity = None
+                last_connection = None
 
-                # Update identity map
-                identity_cache[host] = (identity, last_connection)
+        if identity is None:
+            # Query PSU to retrieve model and serial number (forming identity)
+            query_result = await psu.get_state()
 
-                # Lookup name
-                name = self._psu_identity_to_name.get(identity, "Unnamed")
+            if query_result is None:
+                # Query failed, close connection
+                psu.close()
+                return False
 
-                # Log identity
-                self._logger.info("PSU %s:%d's identity is %s, it's name is '%s'", host, port, identity, name)
+            # Retrieve model and serial number from query result
+            model = query_result.model
+            serial_no = query_result.serial_no
 
-                # Retrieve PSU state object based on identity
-                state = self._psu_states.get_state(identity)
+            # Generate identity, combining model and serial number for cases where a user has
+            # multiple series of PSU with overlapping serial number ranges
+            identity = f"{model}_{serial_no}"
 
-                # Create new bridge instance
-                psu_bridge = Bridge(host, port, identity, model, serial_no, psu, state, self._mqtt_outbound, self._set_clock_on_connection)
+        # Update last connection time
+        last_connection = time_now
 
-                # Add bridge instance to map
-                self._psus[identity] = psu_bridge
+        # Update identity map
+        identity_cache[host] = (identity, model, serial_no, last_connection)
 
-                # Send updated PSU list
-                await self._send_psu_list()
+        # Lookup name
+        name = self._psu_identity_to_name.get(identity, "Unnamed")
 
-        except asyncio.CancelledError:
-            # Task cancelled
-            self._logger.info("PSU task stopped")
+        # Log identity
+        self._logger.info("PSU %s:%d's identity is %s, it's name is '%s'", host, port, identity, name)
 
-    async def _send_psu_list(self) -> None:
-        """Transmit PSU list over MQTT"""
+        # Retrieve PSU state object based on identity
+        state = self._psu_states.get_state(identity)
+
+        # Create new bridge instance
+        psu_bridge = Bridge(host, port, identity, model, serial_no, psu, state, self._mqtt_outbound, self._set_clock_on_connection)
 
-        # Reset list of names and identities
-        psu_name_ident = []
+        # Add bridge instance to maps
+        self._psus[identity] = psu_bridge
+        self._client_to_identity[psu] = identity
 
-        for identity, psu in self._psus.items():
-            name = self._psu_identity_to_name.get(identity, "Unnamed")
-            psu_name_ident.append({"identity" : identity, "name" : name, "model" : psu.model, "serial_no" : psu.serial_no})
+        # Prepare PSU list entry
+        self._psu_list_entries[identity] = {"identity" : identity, "name" : name, "model" : model, "serial_no" : serial_no}
+
+        # Prepare state topic for PSU
+        if identity not in self._state_topics:
+            self._state_topics[identity] = f"{self._mqtt_base_topic}/psu/{identity}/state"
+
+        # Invalidate cached PSU list
+        self._psu_list_cache = None
+
+        return True
+
+    def _send_psu_list(self) -> None:
+        """Transmit PSU list over MQTT"""
+
+        # Rebuild list of names and identities if connected PSUs have changed
+        if self._psu_list_cache is None:
+            self._psu_list_cache = orjson.dumps(list(self._psu_list_entries.values()))
 
         if self._mqtt_client:
-            try:
-                await self._mqtt_client.publish(f"{self._mqtt_base_topic}/psu/list", payload=json.dumps(psu_name_ident))
-            except aiomqtt.MqttError:
-                # Ignore MQTT errors
-                pass
+            self._queue_publish(self._psu_list_topic, self._psu_list_cache)
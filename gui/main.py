@@ -45,6 +45,25 @@ mqtt_reconnect_delay_secs = 5
 ;update_period = 0.25
 """
 
+# Fallback values for options missing from the config file
+MQTT_DEFAULTS = {
+    "hostname" : None,
+    "port" : 1883,
+    "client_id" : None,
+    "username" : None,
+    "password" : None,
+    "ca_cert" : None,
+    "client_cert" : None,
+    "client_key" : None,
+    "insecure" : False,
+}
+GENERAL_DEFAULTS = {
+    "mqtt_base_topic" : "riden_psu",
+    "mqtt_reconnect_delay_secs" : 5,
+    "mqtt_probe_delay_secs" : 1,
+    "update_period" : 0.25,
+}
+
 def main():
     """Entrypoint"""
 
@@ -68,28 +87,41 @@ def main():
     config = configparser.ConfigParser()
     config.read(config_path)
 
+    # Read each section once, merging over defaults
+    mqtt_config = {**MQTT_DEFAULTS, **(dict(config["MQTT"]) if config.has_section("MQTT") else {})}
+    general_config = {**GENERAL_DEFAULTS, **(dict(config["GENERAL"]) if config.has_section("GENERAL") else {})}
+
     # Extract config - MQTT
-    hostname = config.get(section="MQTT", option="hostname", fallback=None)
-    port = config.getint(section="MQTT", option="port", fallback=1883)
-    client_id = config.get(section="MQTT", option="client_id", fallback=None)
-    username = config.get(section="MQTT", option="username", fallback=None)
-    password = config.get(section="MQTT", option="password", fallback=None)
-    ca_cert = config.get(section="MQTT", option="ca_cert", fallback=None)
-    client_cert = config.get(section="MQTT", option="client_cert", fallback=None)
-    client_key = config.get(section="MQTT", option="client_key", fallback=None)
-    insecure = config.getboolean(section="MQTT", option="insecure", fallback=False)
+    hostname = mqtt_config["hostname"]
+    port = int(mqtt_config["port"])
+    client_id = mqtt_config["client_id"]
+    username = mqtt_config["username"]
+    password = mqtt_config["password"]
+    ca_cert = mqtt_config["ca_cert"]
+    client_cert = mqtt_config["client_cert"]
+    client_key = mqtt_config["client_key"]
+    insecure = config.getboolean(section="MQTT", option="insecure", fallback=MQTT_DEFAULTS["insecure"])
 
     # Extract config - general
-    mqtt_base_topic = config.get(section="GENERAL", option="mqtt_base_topic", fallback="riden_psu")
-    mqtt_reconnect_delay_secs = config.getfloat(section="GENERAL", option="mqtt_reconnect_delay_secs", fallback=5)
-    mqtt_probe_delay_secs = config.getfloat(section="GENERAL", option="mqtt_probe_delay_secs", fallback=1)
-    update_period = config.getfloat(section="GENERAL", option="update_period", fallback=0.25)
+    mqtt_base_topic = general_config["mqtt_base_topic"]
+    mqtt_reconnect_delay_secs = float(general_config["mqtt_reconnect_delay_secs"])
+    mqtt_probe_delay_secs = float(general_config["mqtt_probe_delay_secs"])
+    update_period = float(general_config["update_period"])
 
     # Change to the "Selector" event loop if platform is Windows as required by aiomqtt
     if sys.platform.lower() == "win32" or os.name.lower() == "nt":
         from asyncio import set_event_loop_policy, WindowsSelectorEventLoopPolicy
         set_event_loop_policy(WindowsSelectorEventLoopPolicy())
 
+    else:
+        # Otherwise use uvloop where available
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            # Fall back to the default event loop
+            pass
+
     # Create new event loop and assign as asyncio loop
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
@@ -1,13 +1,52 @@
 import asyncio
-import json
+from contextlib import suppress
 from typing import Optional
 import aiomqtt
 
+# Prefer orjson for MQTT payloads, falling back to standard library json (which encodes to str rather than bytes)
+try:
+    import orjson
+except ImportError:
+    import json as orjson
+
 from view_intfc import RidenPSUViewIntfc, RidenPSUListEntry
 
+# Fixed payloads, encoded once
+EMPTY_PAYLOAD = orjson.dumps({}) # Request PSU list
+QUERY_PAYLOAD = orjson.dumps({"query" : True}) # Request PSU is queried and its state published
+PROBE_PAYLOAD = orjson.dumps({"query" : False}) # Request PSU connection status
+
 class RidenPSUModelControl:
     """Model / controller-esq class, managing MQTT connection and interaction between GUI and broker"""
 
+    # Map of state report field -> (view setter name, optional value transform)
+    # Numeric and string fields are passed to view setters as decoded (int / float / str), without re-coercion
+    STATE_HANDLERS = {
+        "current_range" : ("set_current_range", None),
+        "input_voltage" : ("set_input_voltage", None),
+        "output_voltage_set" : ("set_output_voltage_set", None),
+        "output_current_set" : ("set_output_current_set", None),
+        "ovp" : ("set_ovp", None),
+        "ocp" : ("set_ocp", None),
+        "output_voltage_disp" : ("set_output_voltage_disp", None),
+        "output_current_disp" : ("set_output_current_disp", None),
+        "output_power_disp" : ("set_output_power_disp", None),
+        "output_mode" : ("set_cc_cv", lambda x : x == "cc"),
+        "protection_status" : ("set_ovp_ocp", None),
+        "battery_mode" : ("set_batt_state", None),
+        "ext_temp_c" : ("set_temp", None),
+        "batt_ah" : ("set_batt_ah", None),
+        "batt_wh" : ("set_batt_wh", None),
+        "output_enable" : ("set_output_enabled", None),
+    }
+    STATE_KEYS = frozenset(STATE_HANDLERS)
+
+    # Fields required in each PSU list entry
+    PSU_LIST_ENTRY_KEYS = frozenset(("identity", "name", "model", "serial_no"))
+
+    # Delay before publishing state set requests, merging any made in the meantime
+    STATE_SET_FLUSH_DELAY = 0.02 # sec
+
     def __init__(self,
                  hostname:str,
                  port:int,
@@ -39,9 +78,15 @@ class RidenPSUModelControl:
         self._mqtt_probe_delay_secs = mqtt_probe_delay_secs
         self._update_period = update_period
 
-        # Reset MQTT tasks
-        self._mqtt_task_in = None
-        self._mqtt_task_out = None
+        # Reset event loop (retrieved when run)
+        self._loop = None
+
+        # Reset MQTT task
+        self._mqtt_task = None
+
+        # Reset pending state set request and event signalling it requires publishing
+        self._pending_state = {}
+        self._flush_event = asyncio.Event()
 
         # Reset MQTT client
         self._mqtt_client = None
@@ -49,35 +94,53 @@ class RidenPSUModelControl:
         # Reset selected psu
         self._psu_identity = None
 
-        # Reset topic wildcard
-        self._wildcard_state = None
+        # Prepare PSU list topics
+        self._topic_list = f"{self._mqtt_base_topic}/psu/list"
+        self._topic_list_get = f"{self._mqtt_base_topic}/psu/list/get"
+
+        # Reset selected PSU topics
+        self._topic_state = None
+        self._topic_state_get = None
+        self._topic_state_set = None
 
-        # Reset recevied message count
-        self._count_received = 0
+        # Reset message received (since last probe) flag
+        self._received_since_probe = False
+
+        # Reset last PSU list passed to view
+        self._last_psus = None
+
+        # Reset view and its cached state setters
+        self._view = None
+        self._view_calls = {}
 
     def set_view(self, view:RidenPSUViewIntfc):
         """Update view for model / controller"""
 
         self._view = view
+        self._last_psus = None
+
+        # Cache view setter for each state report field, wrapping those requiring their value transformed
+        self._view_calls = {}
+        for key, (method, transform) in self.STATE_HANDLERS.items():
+            setter = getattr(view, method)
+            if transform is not None:
+                setter = lambda x, setter=setter, transform=transform : setter(transform(x))
+            self._view_calls[key] = setter
 
     def run(self) -> None:
         """Start and maintain MQTT connection"""
 
-        # Retreive event loop
-        loop = asyncio.get_event_loop()
+        # Retreive event loop, keeping it to pass requests to
+        self._loop = asyncio.get_event_loop()
 
         # Create task to manage MQTT connection and process inbound messages
-        self._mqtt_task = None
-        loop.call_soon_threadsafe(self._start_mqtt_task)
+        self._loop.call_soon_threadsafe(self._start_mqtt_task)
 
     def stop(self) -> None:
         """Request MQTT client stop"""
 
-        # Retreive event loop
-        loop = asyncio.get_event_loop()
-
         # Cancel MQTT task
-        loop.call_soon_threadsafe(self._stop_mqtt_task)
+        self._loop.call_soon_threadsafe(self._stop_mqtt_task)
 
     def _start_mqtt_task(self):
         """Start MQTT task"""
@@ -86,115 +149,107 @@ class RidenPSUModelControl:
         loop = asyncio.get_event_loop()
 
         # Create task
-        self._mqtt_task_in = loop.create_task(self._mqtt_inbound())
-        self._mqtt_task_out = loop.create_task(self._mqtt_outbound())
+        self._mqtt_task = loop.create_task(self._mqtt_run())
 
     def _stop_mqtt_task(self) -> None:
         """Request MQTT client stop"""
 
-        # Cancel MQTT task
-        if self._mqtt_task_in is not None:
-            self._mqtt_task_in.cancel()
-        if self._mqtt_task_out is not None:
-            self._mqtt_task_out.cancel()
+        # Cancel MQTT task (cancelling the tasks in its group)
+        if self._mqtt_task is not None:
+            self._mqtt_task.cancel()
+
+    async def _mqtt_run(self):
+        """Run MQTT tasks as a group"""
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(self._mqtt_inbound())
+                tg.create_task(self._mqtt_outbound())
+                tg.create_task(self._mqtt_flush())
+
+        except asyncio.CancelledError:
+            # Task cancelled
+            pass
 
     async def _mqtt_inbound(self):
         """Connect and reconnect to MQTT broker as required, subscribing to and reading messages"""
 
+        if self._hostname is None or self._port is None:
+            # Need a config to get any further
+            return
+
+        # Create TLS params
+        tls_params = None
+        tls_insecure = None
+        if (self._ca_cert is not None or (self._client_cert is not None and self._client_key is not None)):
+            tls_params = aiomqtt.TLSParameters(self._ca_cert, self._client_cert, self._client_key)
+            tls_insecure = self._insecure
+
         while True:
             try:
-                if self._hostname is None or self._port is None:
-                    # Need a config to get any further
-                    break
-
-                # Create TLS params
-                tls_params = None
-                tls_insecure = None
-                if (self._ca_cert is not None or (self._client_cert is not None and self._client_key is not None)):
-                    tls_params = aiomqtt.TLSParameters(self._ca_cert, self._client_cert, self._client_key)
-                    tls_insecure = self._insecure
-
-                # Construct client
-                async with aiomqtt.Client(hostname=self._hostname, port=self._port,
-                                          username=self._username, password=self._password,
-                                          tls_params=tls_params,
-                                          tls_insecure=tls_insecure,
-                                          client_id=self._client_id) as client:
+                # Construct client for each connection attempt (as a client isn't reusable after failing to connect)
+                client = aiomqtt.Client(hostname=self._hostname, port=self._port,
+                                        username=self._username, password=self._password,
+                                        tls_params=tls_params,
+                                        tls_insecure=tls_insecure,
+                                        client_id=self._client_id)
+
+                # Connect client
+                async with client:
                     # Make client available to psu connection handler
                     self._mqtt_client = client
 
-                    # Subscribe to PSU topics
-                    await client.subscribe(f"{self._mqtt_base_topic}/psu/list")
-
-                    # Prepare wildcards
-                    wildcard_psus_list = f"{self._mqtt_base_topic}/psu/list"
+                    # Subscribe to PSU list and target PSU topics (if selected) in a single request
+                    topics = [(self._topic_list, 0)]
+                    if self._topic_state is not None:
+                        topics.append((self._topic_state, 0))
+                    await client.subscribe(topics)
 
                     # Publish request for PSU list
-                    await client.publish(topic=f"{self._mqtt_base_topic}/psu/list/get", payload=json.dumps({}), qos=1)
+                    await client.publish(topic=self._topic_list_get, payload=EMPTY_PAYLOAD, qos=1)
 
-                    # Subscribe to target PSU and prepare wildcard
-                    await self._subscribe_to_psu()
+                    # Request a single query from the target PSU
+                    await self._mqtt_publish_state_get(QUERY_PAYLOAD)
 
                     # Retrive messages
                     async with client.messages() as messages:
                         # Process messages
                         async for message in messages:
+                            # Ignore messages on topics we don't act on (such as a previously selected PSU), before de-serializing them
+                            topic = message.topic.value
+                            if topic != self._topic_state and topic != self._topic_list:
+                                continue
+
                             # Attempt to de-serialize message
                             try:
-                                payload = json.loads(message.payload)
+                                payload = orjson.loads(message.payload)
                             except:
                                 continue
 
                             # Act on topics
-                            if self._wildcard_state is not None and message.topic.matches(self._wildcard_state):
+                            if topic == self._topic_state:
                                 # State report, update GUI
                                 if self._view is not None:
                                     self._view.set_connected(payload.get("connected", False))
                                     self._view.set_update_state(payload.get("period", 0) > 0)
-                                    if "current_range" in payload:
-                                        self._view.set_current_range(payload["current_range"])
-                                    if "input_voltage" in payload:
-                                        self._view.set_input_voltage(payload["input_voltage"])
-                                    if "output_voltage_set" in payload:
-                                        self._view.set_output_voltage_set(payload["output_voltage_set"])
-                                    if "output_current_set" in payload:
-                                        self._view.set_output_current_set(payload["output_current_set"])
-                                    if "ovp" in payload:
-                                        self._view.set_ovp(payload["ovp"])
-                                    if "ocp" in payload:
-                                        self._view.set_ocp(payload["ocp"])
-                                    if "output_voltage_disp" in payload:
-                                        self._view.set_output_voltage_disp(payload["output_voltage_disp"])
-                                    if "output_current_disp" in payload:
-                                        self._view.set_output_current_disp(payload["output_current_disp"])
-                                    if "output_power_disp" in payload:
-                                        self._view.set_output_power_disp(payload["output_power_disp"])
-                                    if "output_mode" in payload:
-                                        self._view.set_cc_cv(payload["output_mode"] == "cc")
-                                    if "protection_status" in payload:
-                                        self._view.set_ovp_ocp(payload["protection_status"])
-                                    if "battery_mode" in payload:
-                                        self._view.set_batt_state(payload["battery_mode"])
-                                    if "ext_temp_c" in payload:
-                                        self._view.set_temp(payload["ext_temp_c"])
-                                    if "batt_ah" in payload:
-                                        self._view.set_batt_ah(payload["batt_ah"])
-                                    if "batt_wh" in payload:
-                                        self._view.set_batt_wh(payload["batt_wh"])
-                                    if "output_enable" in payload:
-                                        self._view.set_output_enabled(payload["output_enable"])
-
-                                # Inc counter
-                                self._count_received += 1
-
-                            elif message.topic.matches(wildcard_psus_list):
+
+                                    # Pass remaining fields present to their view setters
+                                    for key in payload.keys() & self.STATE_KEYS:
+                                        self._view_calls[key](payload[key])
+
+                                # Flag message received
+                                self._received_since_probe = True
+
+                            elif topic == self._topic_list:
                                 # PSU list, update GUI
                                 if self._view is not None:
-                                    # Prepare list of PSUS
-                                    psus = []
-                                    for x in payload:
-                                        if "identity" in x and "name" in x and "model" in x and "serial_no" in x:
-                                            psus.append(RidenPSUListEntry(x["identity"], x["name"], x["model"], x["serial_no"]))
+                                    # Prepare list of PSUS (from entries containing all required fields)
+                                    psus = [RidenPSUListEntry(x["identity"], x["name"], x["model"], x["serial_no"]) for x in payload if isinstance(x, dict) and self.PSU_LIST_ENTRY_KEYS <= x.keys()]
+
+                                    # Skip GUI update if list is unchanged (such as when it's resent following a reconnect)
+                                    if psus == self._last_psus:
+                                        continue
+                                    self._last_psus = psus
 
                                     # Inform GUI
                                     self._view.set_psus(psus)
@@ -227,13 +282,11 @@ class RidenPSUModelControl:
                 await asyncio.sleep(self._mqtt_probe_delay_secs)
 
                 # Check message received
-                if self._count_received == 0:
+                if not self._received_since_probe:
                     # No messages, received probe for PSU status
                     if self._mqtt_client is not None and self._psu_identity is not None:
-                        try:
-                            await self._mqtt_client.publish(f"{self._mqtt_base_topic}/psu/{self._psu_identity}/state/get", payload=json.dumps({"query" : False}))
-                        except aiomqtt.MqttError:
-                            pass
+                        with suppress(aiomqtt.MqttError):
+                            await self._mqtt_client.publish(self._topic_state_get, payload=PROBE_PAYLOAD, qos=0)
 
                     # Inc counter
                     count_sent += 1
@@ -246,8 +299,8 @@ class RidenPSUModelControl:
                     # Reset counter
                     count_sent = 0
 
-                # Reset counter
-                self._count_received = 0
+                # Reset flag
+                self._received_since_probe = False
 
         except asyncio.CancelledError:
             # Task cancelled
@@ -256,112 +309,113 @@ class RidenPSUModelControl:
     def set_psu(self, identity:str) -> None:
         """Set PSU to monitor / control"""
 
-        asyncio.run_coroutine_threadsafe(self._subscribe_to_psu(identity), asyncio.get_event_loop())
+        asyncio.run_coroutine_threadsafe(self._subscribe_to_psu(identity), self._loop)
 
     async def _subscribe_to_psu(self, new_identity:Optional[str]=None):
         """Subscribe (or resubscribe) to (possibly different) PSU"""
 
-        if new_identity is not None and self._psu_identity is not None:
-            # New identity being set, unsubscribe from old one
-            if self._mqtt_client is not None:
-                try:
-                    await self._mqtt_client.unsubscribe(f"{self._mqtt_base_topic}/psu/{self._psu_identity}/state")
-                except aiomqtt.MqttError:
-                    pass
+        # Keep old topic, to unsubscribe from if identity is changing
+        old_topic = self._topic_state if new_identity is not None else None
+
+        if new_identity is not None and self._pending_state:
+            # Publish any pending state set request to old PSU now, before its topics are replaced (rather than the flush task sending it to the new PSU)
+            state = self._pending_state
+            self._pending_state = {}
+            await self._mqtt_publish_state_set(state)
 
         if new_identity is not None:
-            # Update PSU
+            # Update PSU and its topics
             self._psu_identity = new_identity
+            self._topic_state = f"{self._mqtt_base_topic}/psu/{self._psu_identity}/state"
+            self._topic_state_get = f"{self._mqtt_base_topic}/psu/{self._psu_identity}/state/get"
+            self._topic_state_set = f"{self._mqtt_base_topic}/psu/{self._psu_identity}/state/set"
 
-        if self._psu_identity is not None:
-            # Subscribe
-            await self._mqtt_client.subscribe(f"{self._mqtt_base_topic}/psu/{self._psu_identity}/state")
-
-            # Prepare topic wildcard
-            self._wildcard_state = f"{self._mqtt_base_topic}/psu/{self._psu_identity}/state"
+        if self._mqtt_client is not None and self._psu_identity is not None:
+            # Unsubscribe from old PSU (if any) and subscribe to new one, issuing both requests back-to-back
+            requests = []
+            if old_topic is not None and old_topic != self._topic_state:
+                requests.append(self._mqtt_client.unsubscribe(old_topic))
+            requests.append(self._mqtt_client.subscribe(self._topic_state))
+            await asyncio.gather(*requests, return_exceptions=True)
 
         # Request a single query from the PSU
-        await self._mqtt_publish_state_get({"query" : True})
+        await self._mqtt_publish_state_get(QUERY_PAYLOAD)
 
     # Interface implementation, passing requests to asyncio thread for processing
     def set_update(self, enabled:bool) -> None:
         """Set update period (auto-update enabled / disabled)"""
-        asyncio.run_coroutine_threadsafe(self._set_update(enabled), asyncio.get_event_loop())
+        self._loop.call_soon_threadsafe(self._queue_state_set, {"period" : self._update_period if enabled else 0.0})
 
     def set_voltage(self, value:float) -> None:
         """Set new voltage"""
-        asyncio.run_coroutine_threadsafe(self._set_voltage(value), asyncio.get_event_loop())
+        self._loop.call_soon_threadsafe(self._queue_state_set, {"output_voltage_set" : value})
 
     def set_current(self, value:float) -> None:
         """Set new current"""
-        asyncio.run_coroutine_threadsafe(self._set_current(value), asyncio.get_event_loop())
+        self._loop.call_soon_threadsafe(self._queue_state_set, {"output_current_set" : value})
 
     def set_ovp(self, value:float) -> None:
         """Set new over-voltage protection limit"""
-        asyncio.run_coroutine_threadsafe(self._set_ovp(value), asyncio.get_event_loop())
+        self._loop.call_soon_threadsafe(self._queue_state_set, {"ovp" : value})
 
     def set_ocp(self, value:float) -> None:
         """Set new over-current protection limit"""
-        asyncio.run_coroutine_threadsafe(self._set_ocp(value), asyncio.get_event_loop())
+        self._loop.call_soon_threadsafe(self._queue_state_set, {"ocp" : value})
 
     def set_preset(self, index:int) -> None:
         """Set new preset number"""
-        asyncio.run_coroutine_threadsafe(self._set_preset(index), asyncio.get_event_loop())
+        self._loop.call_soon_threadsafe(self._queue_state_set, {"preset_index" : index})
 
     def toggle_output_enable(self) -> None:
         """Toggle output state"""
-        asyncio.run_coroutine_threadsafe(self._toggle_output_enable(), asyncio.get_event_loop())
+        self._loop.call_soon_threadsafe(self._toggle_output_enable)
 
     # Asyncio helper functions
-    async def _set_update(self, enabled:bool) -> None:
-        """Set update period (auto-update enabled / disabled) - helper"""
-
-        await self._mqtt_publish_state_set({"period" : self._update_period if enabled else 0.0})
-
-    async def _set_voltage(self, value:float) -> None:
-        """Set new voltage - helper"""
-
-        await self._mqtt_publish_state_set({"output_voltage_set" : value})
-
-    async def _set_current(self, value:float) -> None:
-        """Set new current - helper"""
+    def _toggle_output_enable(self) -> None:
+        """Toggle output state - helper"""
 
-        await self._mqtt_publish_state_set({"output_current_set" : value})
+        # A toggle awaiting publishing is cancelled out by this one
+        if self._pending_state.pop("output_toggle", False):
+            return
 
-    async def _set_ovp(self, value:float) -> None:
-        """Set new over-voltage protection limit - helper"""
+        self._queue_state_set({"output_toggle" : True})
 
-        await self._mqtt_publish_state_set({"ovp" : value})
+    def _queue_state_set(self, state:dict) -> None:
+        """Merge state set request into pending request, to be published by flush task"""
 
-    async def _set_ocp(self, value:float) -> None:
-        """Set new over-current protection limit - helper"""
+        self._pending_state.update(state)
+        self._flush_event.set()
 
-        await self._mqtt_publish_state_set({"ocp" : value})
+    async def _mqtt_flush(self):
+        """Publish pending state set requests, merging those made in quick succession into one message"""
 
-    async def _set_preset(self, index:int) -> None:
-        """Set new preset number - helper"""
+        try:
+            while True:
+                # Wait for a request, then a while longer for any that follow it
+                await self._flush_event.wait()
+                await asyncio.sleep(self.STATE_SET_FLUSH_DELAY)
+                self._flush_event.clear()
 
-        await self._mqtt_publish_state_set({"preset_index" : index})
+                # Take and publish pending request (which may be empty if toggles cancelled each other out)
+                state = self._pending_state
+                self._pending_state = {}
+                if state:
+                    await self._mqtt_publish_state_set(state)
 
-    async def _toggle_output_enable(self) -> None:
-        """Toggle output state - helper"""
-
-        await self._mqtt_publish_state_set({"output_toggle" : True})
+        except asyncio.CancelledError:
+            # Task cancelled
+            pass
 
-    async def _mqtt_publish_state_get(self, state:dict):
-        """Publish state set request on current PSU topic"""
+    async def _mqtt_publish_state_get(self, payload:bytes):
+        """Publish (encoded) state get request on current PSU topic"""
 
         if self._mqtt_client is not None and self._psu_identity is not None:
-            try:
-                await self._mqtt_client.publish(f"{self._mqtt_base_topic}/psu/{self._psu_identity}/state/get", payload=json.dumps(state))
-            except aiomqtt.MqttError:
-                pass
+            with suppress(aiomqtt.MqttError):
+                await self._mqtt_client.publish(self._topic_state_get, payload=payload, qos=0)
 
     async def _mqtt_publish_state_set(self, state:dict):
         """Publish state set request on current PSU topic"""
 
         if self._mqtt_client is not None and self._psu_identity is not None:
-            try:
-                await self._mqtt_client.publish(f"{self._mqtt_base_topic}/psu/{self._psu_identity}/state/set", payload=json.dumps(state))
-            except aiomqtt.MqttError:
-                pass
+            with suppress(aiomqtt.MqttError):
+                await self._mqtt_client.publish(self._topic_state_set, payload=orjson.dumps(state), qos=0)
@@ -1,32 +1,15 @@
 import abc
+from dataclasses import dataclass
 from typing import List
 
+@dataclass(frozen=True, slots=True)
 class RidenPSUListEntry:
     """PSU name and identity to include in PSU list"""
 
-    def __init__(self, identity:str, name:str, model:int, serial_no:int) -> None:
-        """Construct entry"""
-
-        self._identity = identity
-        self._name = name
-        self._model = model
-        self._serial_no = serial_no
-
-    @property
-    def identity(self) -> str:
-        return self._identity
-
-    @property
-    def name(self) -> str:
-        return self._name
-
-    @property
-    def model(self) -> int:
-        return self._model
-
-    @property
-    def serial_no(self) -> int:
-        return self._serial_no
+    identity:str
+    name:str
+    model:int
+    serial_no:int
 
     def __str__(self) -> str:
         return f"{self.name} (RD{self.model // 10} #{self.serial_no})"
@@ -9,6 +9,21 @@ import time
 # Based on espressif example app (Android version)
 # https://github.com/EspressifApp/EsptouchForAndroid/blob/master/esptouch/src/main/java/com/espressif/iot/esptouch/protocol/EsptouchGenerator.java
 
+def _build_crc_table(polynom:int) -> bytes:
+    """Build lookup table for (reflected) CRC polynomial"""
+
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if ((crc & 0x01) != 0):
+                crc = (crc >> 1) ^ polynom
+            else:
+                crc >>= 1
+        table[i] = crc
+
+    return bytes(table)
+
 class EspTouchCRC:
     """
     Implements CRC algorithm used by ESPTouch
@@ -17,37 +32,27 @@ class EspTouchCRC:
     """
     CRC_POLYNOM = 0x8c # 0x31 reflected
 
-    # Static table
-    crcTable = None
-
     def __init__(self, init=0):
         """Construct CRC instance"""
 
-        # Prepare table on first call
-        if EspTouchCRC.crcTable is None:
-            EspTouchCRC.crcTable = [0] * 256
-            for i in range(256):
-                crc = i
-                for _ in range(8):
-                    if ((crc & 0x01) != 0):
-                        crc = (crc >> 1) ^ EspTouchCRC.CRC_POLYNOM
-                    else:
-                        crc >>= 1
-                EspTouchCRC.crcTable[i] = crc
-
         # Set current value from initial
         self.value = init
 
     def update(self, data:bytes):
         """Update CRC with provided data"""
 
+        # xor in each new byte and update value using lookup table (working on locals)
+        tbl = _CRC_TABLE
+        value = self.value
         for d in data:
-            # xor in new data and update value using lookup table
-            d ^= self.value
-            self.value = (EspTouchCRC.crcTable[d & 0xff] ^ (self.value << 8)) & 0xFFFF
+            value = tbl[value ^ d]
+        self.value = value
 
         # Return new CRC value
-        return self.value & 0xFF
+        return value
+
+# Static table, built once on import
+_CRC_TABLE = _build_crc_table(EspTouchCRC.CRC_POLYNOM)
 
 class ESPTouchDataCode:
     """Represents a data byte to be encoded and transmitted"""
@@ -64,8 +69,8 @@ class ESPTouchDataCode:
         # Split byte into two nibbles
         self.data_high, self.data_low = self._split_byte(data)
 
-        # CRC byte and index
-        crc = EspTouchCRC().update(data.to_bytes() + index.to_bytes())
+        # CRC byte and index (looking up each byte directly in table)
+        crc = _CRC_TABLE[_CRC_TABLE[data] ^ index]
 
         # Split crc into two nibbles
         self.crc_high, self.crc_low = self._split_byte(crc)
@@ -73,56 +78,126 @@ class ESPTouchDataCode:
         # Store index as sequence number
         self.seq_no = index
 
+        # Prepare bytes representing data code
+        self._bytes = bytes((0x00, self._combine_byte(self.crc_high, self.data_high),
+                             0x01, self.seq_no,
+                             0x00, self._combine_byte(self.crc_low, self.data_low)))
+
     def to_bytes(self) -> bytes:
         """Retreive bytes representing data code"""
 
-        buffer = bytearray()
-        buffer.append(0x00)
-        buffer.append(self._combine_byte(self.crc_high, self.data_high))
-        buffer.append(0x01)
-        buffer.append(self.seq_no)
-        buffer.append(0x00)
-        buffer.append(self._combine_byte(self.crc_low, self.data_low))
-        return bytes(buffer)
+        return self._bytes
 
-    def _split_byte(self, data:bytes):
+    def _split_byte(self, data:int):
         """Split byte into its upper and lower nibble"""
 
-        high = (data & 0xF0) >> 4
-        low = (data & 0x0F) >> 0
-
-        high = struct.pack("B", high)[0]
-        low = struct.pack("B", low)[0]
-
-        return (high, low)
+        return ((data >> 4) & 0x0F, data & 0x0F)
 
     def _combine_byte(self, high, low) -> int:
         """Combine upper and lower nibble into byte"""
 
         return ((high & 0x0f) << 4) | (low & 0x0f)
 
-class ESPTouch:
-    """Implementation of ESPTouch device provisioning algorithm"""
+class ESPTouchSender:
+    """Transmits ESPTouch packets from background thread, sharing a single UDP socket between streams"""
 
-    def __init__(self, ssid, password, ip=None, bssid="00:00:00:00:00:00") -> None:
+    def __init__(self, ip=None) -> None:
         """Construct instance"""
 
-        # Store arguments
-        self._ssid = ssid
-        self._password = password
-        self._ip = ip
-        self._bssid = bssid
+        # Store IP to transmit from
+        self.ip = ip
 
         # Open, bind and "connect" UDP socket
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        if self._ip is not None:
+        # Request generous send buffer, such that sends don't stall (disrupting packet timing) if the interface is briefly busy
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 262144)
+        if self.ip is not None:
             # Bind to specified IP
-            self._sock.bind((self._ip, 0))
+            self._sock.bind((self.ip, 0))
         self._sock.connect(("255.255.255.255", 7001))
-        if self._ip is None:
+        if self.ip is None:
             # Retrieve IP that the OS has bound the socket to
-            self._ip = self._sock.getsockname()[0]
+            self.ip = self._sock.getsockname()[0]
+
+        # Reset thread
+        self._thread = None
+        self._should_be_running = False
+
+    def start(self, guide_code_packets:List[memoryview], datum_code_packets:List[memoryview]):
+        """Transmit packets in background thread until stopped"""
+
+        # Start provisioning thread
+        self._should_be_running = True
+        self._thread = threading.Thread(target=self._thread_target, args=(guide_code_packets, datum_code_packets), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop transmitting"""
+
+        # Request provisioning thread stop, waiting for it to do so by joining with it
+        self._should_be_running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _thread_target(self, guide_code_packets:List[memoryview], datum_code_packets:List[memoryview]):
+        """Entrypoint for thread"""
+
+        # Define timeouts and intervals (secs), lifting from demo app
+        interval_guide_code = 8 / 1000.0
+        interval_data_code = 8 / 1000.0
+        timeout_guide_code = 2000 / 1000.0
+        timeout_data_code = 4000 / 1000.0
+
+        # Cache socket send and timing functions in locals for send loops
+        send = self._sock.send
+        sleep = time.sleep
+        monotonic = time.monotonic
+
+        # Send packets until stopped
+        index = 0
+        increment = 3
+        while self._should_be_running:
+            # Send guide code, sleeping until each packet's deadline rather than for a fixed interval (so time spent sending doesn't accumulate)
+            start = next_send = monotonic()
+            while self._should_be_running and (next_send - start) < timeout_guide_code:
+                for datagram in guide_code_packets:
+                    send(datagram)
+                    next_send += interval_guide_code
+                    now = monotonic()
+                    if next_send > now:
+                        sleep(next_send - now)
+                    else:
+                        # Running late, send next packet now without attempting to catch up
+                        next_send = now
+
+            # Send data
+            start = next_send = monotonic()
+            while self._should_be_running and (next_send - start) < timeout_data_code:
+                for datagram in datum_code_packets[index:index+increment]:
+                    send(datagram)
+                    next_send += interval_data_code
+                    now = monotonic()
+                    if next_send > now:
+                        sleep(next_send - now)
+                    else:
+                        # Running late, send next packet now without attempting to catch up
+                        next_send = now
+                index = (index + increment) % len(datum_code_packets)
+
+class ESPTouch:
+    """Implementation of ESPTouch device provisioning algorithm"""
+
+    def __init__(self, ssid, password, sender:ESPTouchSender, bssid="00:00:00:00:00:00") -> None:
+        """Construct instance"""
+
+        # Store arguments, taking IP from sender
+        self._ssid = ssid
+        self._password = password
+        self._sender = sender
+        self._ip = sender.ip
+        self._bssid = bssid
 
         # Convert arguments to binary
         ssid_enc = self._ssid.encode()
@@ -132,14 +207,10 @@ class ESPTouch:
 
         # Generate guide code
         guide_code_packet_lengths = [515, 514, 513, 512]
-        self._guide_code_packets = [b"\x01" * i for i in guide_code_packet_lengths]
 
         # Generate data code
         # Data = total len(1 byte) + apPwd len(1 byte) + SSID CRC(1 byte) + BSSID CRC(1 byte) + TOTAL XOR(1 byte) + ipAddress(4 byte) + apPwd + apSsid apPwdLen <= 105 at the moment
 
-        # Reset xor
-        total_xor = 0
-
         # Retrieve password length
         password_len = len(password_enc)
 
@@ -159,117 +230,58 @@ class ESPTouch:
         extra_head_len = 5
         total_len = extra_head_len + ip_len + password_len + ssid_len
 
-        # Prepare list of data codex
-        codes:List[ESPTouchDataCode] = []
-
-        codes.append(ESPTouchDataCode(total_len.to_bytes()[0], 0))
-        total_xor ^= total_len
+        # Assemble header (less total xor) and data, each byte of which is encoded as a data code
+        header = bytes((total_len, password_len, ssid_crc, bssid_crc))
+        data = ip_enc + password_enc + ssid_enc
 
-        codes.append(ESPTouchDataCode(password_len.to_bytes()[0], 1))
-        total_xor ^= password_len
-
-        codes.append(ESPTouchDataCode(ssid_crc.to_bytes()[0], 2))
-        total_xor ^= ssid_crc
-
-        codes.append(ESPTouchDataCode(bssid_crc.to_bytes()[0], 3))
-        total_xor ^= bssid_crc
-
-        # Data index 4 null
-
-        # Add IP
-        for i in range(ip_len):
-            b = ip_enc[i]
-            codes.append(ESPTouchDataCode(b, extra_head_len + i))
-            total_xor ^= b
-
-        # Add password
-        for i in range(password_len):
-            b = password_enc[i]
-            codes.append(ESPTouchDataCode(b, extra_head_len + ip_len + i))
+        # Calculate total xor over header and data
+        total_xor = 0
+        for b in header + data:
             total_xor ^= b
 
-        # Add SSID
-        for i in range(ssid_len):
-            b = ssid_enc[i]
-            codes.append(ESPTouchDataCode(b, extra_head_len + ip_len + password_len + i))
-            total_xor ^= b
+        # Prepare list of data codes in a single pass over each, with header at index 0 -> 3 and data from index 5
+        codes:List[ESPTouchDataCode] = [ESPTouchDataCode(b, i) for i, b in enumerate(header)]
+        codes.extend(ESPTouchDataCode(b, extra_head_len + i) for i, b in enumerate(data))
 
-        # Add total xor
+        # Add total xor at (skipped) index 4
         codes.append(ESPTouchDataCode(total_xor, 4))
 
-        # Add BSSID
-        bssid_insert_index = extra_head_len
-        for i in range(len(bssid_enc)):
-            b = bssid_enc[i]
-            code = ESPTouchDataCode(b, total_len + i)
-            if (bssid_insert_index >= len(codes)):
-                code.append(code)
-            else:
-                codes.insert(bssid_insert_index, code)
-            bssid_insert_index += 4
+        # Add BSSID, interleaving a byte every fourth code from index 5 (appending any remaining once codes run out) in a single pass
+        bssid_codes = [ESPTouchDataCode(b, total_len + i) for i, b in enumerate(bssid_enc)]
+        bssid_index = 0
+        codes_with_bssid:List[ESPTouchDataCode] = []
+        for code in codes:
+            if bssid_index < len(bssid_codes) and len(codes_with_bssid) == extra_head_len + 4 * bssid_index:
+                codes_with_bssid.append(bssid_codes[bssid_index])
+                bssid_index += 1
+            codes_with_bssid.append(code)
+        codes_with_bssid.extend(bssid_codes[bssid_index:])
+        codes = codes_with_bssid
 
         # Retrieve complete datum code as bytes
-        datum_code_bytes = bytearray()
-        for code in codes:
-            datum_code_bytes.extend(code.to_bytes())
+        datum_code_bytes = b"".join(code.to_bytes() for code in codes)
 
-        # Convert bytes to packet lengths
+        # Convert bytes to packet lengths (each pair of bytes being a big-endian length)
         extra_length = 40
-        datum_code_packet_lengths = []
-        for i in range(len(datum_code_bytes) // 2):
-            high = datum_code_bytes[i * 2 + 0]
-            low = datum_code_bytes[i * 2 + 1]
-            high_low = ((high & 0xFF) << 8) | ((low & 0xFF) << 0)
-            datum_code_packet_lengths.append(high_low + extra_length)
-
-        # Generate packets based on lengths
-        self._datum_code_packets = [b"\x01" * i for i in datum_code_packet_lengths]
-
-        # Construct thread to run
-        self._thread = threading.Thread(target=self._thread_target, daemon=True)
-        self._should_be_running = True
+        datum_code_packet_lengths = [high_low + extra_length for (high_low,) in struct.iter_unpack(">H", datum_code_bytes)]
+
+        # Generate packets based on lengths, as views of a single shared buffer (as only their lengths matter)
+        packet_buffer = memoryview(b"\x01" * max(guide_code_packet_lengths + datum_code_packet_lengths))
+        self._guide_code_packets = [packet_buffer[:i] for i in guide_code_packet_lengths]
+        self._datum_code_packets = [packet_buffer[:i] for i in datum_code_packet_lengths]
 
     def start(self):
         """Transmit ESP touch messages in background thread until stopped"""
 
-        # Start provisioning thread
-        self._thread.start()
+        # Pass packets to sender to transmit
+        #print(f"Sending - SSID: {self._ssid}, Password: {self._password[0]}xxx{self._password[-1]} IP: {self._ip} BSSID: {self._bssid}")
+        self._sender.start(self._guide_code_packets, self._datum_code_packets)
 
     def stop(self):
         """Stop transmitting"""
 
-        # Request provisioning thread stop, waiting for it to do so by joining with it
-        self._should_be_running = False
-        self._thread.join()
-
-    def _thread_target(self):
-        """Entrypoint for thread"""
-
-        # Define timeouts and intervals, lifting from demo app
-        interval_guide_code = 8
-        interval_data_code = 8
-        timeout_guide_code = 2000
-        timeout_data_code = 4000
-
-        # Send packets until stopped
-        index = 0
-        increment = 3
-        #print(f"Sending - SSID: {self._ssid}, Password: {self._password[0]}xxx{self._password[-1]} IP: {self._ip} BSSID: {self._bssid}")
-        while self._should_be_running:
-            # Send guide code
-            start = time.time()
-            while self._should_be_running and (time.time() - start) < (timeout_guide_code / 1000.0):
-                for datagram in self._guide_code_packets:
-                    self._sock.send(datagram)
-                    time.sleep(interval_guide_code / 1000.0)
-
-            # Send data
-            start = time.time()
-            while self._should_be_running and (time.time() - start) < (timeout_data_code / 1000.0):
-                for datagram in self._datum_code_packets[index:index+increment]:
-                    self._sock.send(datagram)
-                    time.sleep(interval_data_code / 1000.0)
-                index = (index + increment) % len(self._datum_code_packets)
+        # Request sender stop transmitting
+        self._sender.stop()
 
 def main():
     """Entrypoint"""
@@ -283,9 +295,12 @@ def main():
         parser.add_argument("--adapter_ip", type=str, help="IP address of the local Wi-Fi adapter to transmit provisioning data on")
         args = parser.parse_args()
 
+        # Prepare sender, shared between streams as they're never transmitted at the same time
+        sender = ESPTouchSender(args.adapter_ip)
+
         # Generate one data stream for IP and another for password
-        instance_ip = ESPTouch(args.ssid, args.endpoint_ip, args.adapter_ip)
-        instance_pass = ESPTouch(args.ssid, args.password, args.adapter_ip)
+        instance_ip = ESPTouch(args.ssid, args.endpoint_ip, sender)
+        instance_pass = ESPTouch(args.ssid, args.password, sender)
 
         # Send IP stream first
         instance_ip.start()
@@ -1,4 +1,20 @@
 import json
+import numpy as np
+
+def _build_crc_table(polynom:int) -> bytes:
+    """Build lookup table for (reflected) CRC polynomial"""
+
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if ((crc & 0x01) != 0):
+                crc = (crc >> 1) ^ polynom
+            else:
+                crc >>= 1
+        table[i] = crc
+
+    return bytes(table)
 
 class EspTouchCRC:
     """
@@ -8,37 +24,30 @@ class EspTouchCRC:
     """
     CRC_POLYNOM = 0x8c # 0x31 reflected
 
-    # Static table
-    crcTable = None
-
     def __init__(self, init=0):
         """Construct CRC instance"""
 
-        # Prepare table on first call
-        if EspTouchCRC.crcTable is None:
-            EspTouchCRC.crcTable = [0] * 256
-            for i in range(256):
-                crc = i
-                for _ in range(8):
-                    if ((crc & 0x01) != 0):
-                        crc = (crc >> 1) ^ EspTouchCRC.CRC_POLYNOM
-                    else:
-                        crc >>= 1
-                EspTouchCRC.crcTable[i] = crc
-
         # Set current value from initial
         self.value = init
 
     def update(self, data:bytes):
         """Update CRC with provided data"""
 
+        # xor in each new byte and update value using lookup table (working on locals)
+        tbl = _CRC_TABLE
+        value = self.value
         for d in data:
-            # xor in new data and update value using lookup table
-            d ^= self.value
-            self.value = (EspTouchCRC.crcTable[d & 0xff] ^ (self.value << 8)) & 0xFFFF
+            value = tbl[value ^ d]
+        self.value = value
 
         # Return new CRC value
-        return self.value & 0xFF
+        return value
+
+# Static table, built once on import
+_CRC_TABLE = _build_crc_table(EspTouchCRC.CRC_POLYNOM)
+
+# Static table of CRCs of (data, sequence number) byte pairs, indexed by data << 8 | sequence number
+_CRC2_TABLE = np.frombuffer(bytes(_CRC_TABLE[_CRC_TABLE[data] ^ seqno] for data in range(256) for seqno in range(256)), dtype=np.uint8)
 
 class ESPTouchDecode:
     """
@@ -59,80 +68,45 @@ class ESPTouchDecode:
             udp_len = int(pkt["_source"]["layers"].get("data", {}).get("data.len", "0"))
             lens.append(udp_len)
 
-        # Split lengths into msb and lsb bytes
-        tuples = []
-        for l in lens:
-            # Subtract magic +40 added to packet lengths
-            l -= 40
-
-            # Split length into bytes
-            upper = (l >> 8) & 0xff
-            lower = (l >> 0) & 0xff
-
-            tuples.append((upper, lower))
-
-        # Extract data from tuples
-        extracted_data = {}
-        for i in range(1, len(tuples) - 1):
-            # Place a sliding window over the packet lengths
-            a_index, a_data = tuples[i - 1]
-            b_index, b_data = tuples[i]
-            c_index, c_data = tuples[i + 1]
-
-            # Check for expected sequence
-            if a_index == 0 and b_index == 1 and c_index == 0:
-                # Found a sequence, attempt to extract data
-                high_crc = (a_data >> 4) & 0x0f
-                high_data = (a_data >> 0) & 0x0f
+        # Subtract magic +40 added to packet lengths
+        lens = np.asarray(lens, dtype=np.int32) - 40
 
-                low_crc = (c_data >> 4) & 0x0f
-                low_data = (c_data >> 0) & 0x0f
-
-                crc = (high_crc << 4) | low_crc
-                data = (high_data << 4) | low_data
-
-                seqno = b_data
-
-                # Verify CRC
-                calc = EspTouchCRC()
-                calc.update(data.to_bytes())
-                calc_crc = calc.update(seqno.to_bytes())
-                crc_good = (calc_crc == crc)
-
-                if crc_good:
-                    # So far so good
-                    #print(f"SEQ: {seqno}, DATA: {data:02X}, CRC: {crc:02X}, CRCOK: {crc_good}")
-
-                    # Add sequence number and byte to extracted data buffer, incrementing count if already seen
-                    index_data = (seqno, data)
-
-                    # Ensure data stored
-                    if not index_data in extracted_data:
-                        extracted_data[index_data] = 0
-
-                    # Increment number of times seen
-                    extracted_data[index_data] += 1
-
-        # Filter data by number of times each entry is seen
-        filtered_data = {}
-        for index_data, count in extracted_data.items():
-            index, data = index_data
-
-            if not index in filtered_data:
-                # First time data seen, add it
-                filtered_data[index] = (data, count)
-
-            if count > filtered_data[index][1]:
-                # This version of the same index occurred more times, prefer it
-                filtered_data[index] = (data, count)
+        # Split lengths into msb and lsb bytes
+        upper = (lens >> 8) & 0xff
+        lower = (lens >> 0) & 0xff
+
+        # Place a sliding window over the packet lengths, finding all expected sequences (msb of 0, 1, 0) at once by packing each window's msbs into a single value
+        mask = ((upper[:-2] << 16) | (upper[1:-1] << 8) | upper[2:]) == 0x000100
+        a_data = lower[:-2][mask]
+        b_data = lower[1:-1][mask]
+        c_data = lower[2:][mask]
+
+        # Extract crc, data and sequence number from each sequence found
+        crcs = (a_data & 0xf0) | ((c_data >> 4) & 0x0f)
+        datas = ((a_data & 0x0f) << 4) | (c_data & 0x0f)
+        seqnos = b_data
+
+        # Verify CRCs, keeping only sequences which pass
+        crc_good = _CRC2_TABLE[(datas << 8) | seqnos] == crcs
+        datas = datas[crc_good]
+        seqnos = seqnos[crc_good]
+
+        # Count number of times each (sequence number, data) pair is seen, noting where each was first seen
+        pairs, first_seen, counts = np.unique((seqnos << 8) | datas, return_index=True, return_counts=True)
+        pair_seqnos = pairs >> 8
+        pair_datas = pairs & 0xff
+
+        # Filter data by number of times each pair is seen, ordering pairs by sequence number then most seen (preferring the first seen if tied) and keeping the first for each sequence number
+        order = np.lexsort((first_seen, -counts, pair_seqnos))
+        filtered_seqnos, keep = np.unique(pair_seqnos[order], return_index=True)
+        filtered_datas = pair_datas[order][keep]
+        filtered_counts = counts[order][keep]
 
         # Extract raw data from filtered
         raw_data = []
         last_index = -1
-        for index in sorted(filtered_data.keys()):
-            # Process next data byte, having sorted the keys array (data byte index)
-            data = filtered_data[index][0]
-            count = filtered_data[index][1]
+        for index, data, count in zip(filtered_seqnos.tolist(), filtered_datas.tolist(), filtered_counts.tolist()):
+            # Process next data byte (in data byte index order)
 
             #print(f"{key} = {data:02X} ({count})")
             #print(f"{data:02X}", end='')